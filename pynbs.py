@@ -5,8 +5,12 @@ try:
 except ImportError:
     range = xrange
 
+from codecs import utf_8_decode
+from mmap import mmap, ACCESS_READ
 from struct import Struct
 from collections import namedtuple
+from itertools import groupby
+from operator import attrgetter
 
 
 __all__ = ['read', 'new_file', 'Parser', 'Writer', 'File', 'Header',
@@ -19,6 +23,22 @@ SHORT = Struct('<H')
 SSHORT = Struct('<h')
 INT = Struct('<I')
 
+NOTE = Struct('<BB')
+NOTE_V4 = Struct('<BBBBh')
+LAYER_NOTE = Struct('<HBB')
+LAYER_NOTE_V4 = Struct('<HBBBBh')
+
+# Velocity, panning and pitch of notes saved before version 4
+NOTE_DEFAULTS = (100, 0, 0)
+
+HEADER_V1 = Struct('<BH')
+HEADER_V3 = Struct('<BHH')
+HEADER_SETTINGS = Struct('<HBBB')
+HEADER_STATS = Struct('<5I')
+HEADER_LOOP = Struct('<BBH')
+
+EMPTY_STRING = INT.pack(0)
+
 
 
 Instrument = namedtuple('Instrument', ['id', 'name', 'file', 'pitch',
@@ -39,7 +59,19 @@ class Layer(namedtuple('Layer', ['id', 'name', 'lock', 'volume', 'panning'])):
 
 def read(filename):
     with open(filename, 'rb') as buff:
-        return Parser(buff).read_file()
+        try:
+            mapped = mmap(buff.fileno(), 0, access=ACCESS_READ)
+        except (ValueError, OSError):
+            # Empty files, pipes and other unmappable inputs
+            return Parser(buff).read_file()
+    try:
+        parser = Parser(mapped)
+        try:
+            return parser.read_file()
+        finally:
+            parser.data.release()
+    finally:
+        mapped.close()
 
 
 def new_file(**header):
@@ -89,7 +121,7 @@ class File(object):
     def update_header(self, version):
         self.header.version = version
         if self.notes:
-            self.header.song_length = self.notes[-1].tick
+            self.header.song_length = max(note.tick for note in self.notes)
         self.header.song_layers = len(self.layers)
 
     def save(self, filename, version=CURRENT_NBS_VERSION):
@@ -98,48 +130,45 @@ class File(object):
             Writer(buff).encode_file(self, version)
 
     def __iter__(self):
-        if not self.notes:
-            return
-        chord = []
-        current_tick = self.notes[0].tick
-
-        for note in sorted(self.notes, key=lambda n: n.tick):
-            if note.tick == current_tick:
-                chord.append(note)
-            else:
-                chord.sort(key=lambda n: n.layer)
-                yield current_tick, chord
-                current_tick, chord = note.tick, [note]
-        yield current_tick, chord
+        notes = sorted(self.notes, key=attrgetter('tick', 'layer'))
+        for tick, chord in groupby(notes, key=attrgetter('tick')):
+            yield tick, list(chord)
 
 
 class Parser(object):
     def __init__(self, buff):
-        self.buffer = buff
+        try:
+            self.data = memoryview(buff)
+        except TypeError:
+            self.data = memoryview(buff.read())
+        self.pos = 0
 
     def read_file(self):
         values = self.parse_header()
         header = Header(**values)
         version = values['version']
-        return File(header, list(self.parse_notes(version)),
-                    list(self.parse_layers(header.song_layers, version)),
-                    list(self.parse_instruments(version)))
+        return File(header, self.parse_notes(version),
+                    self.parse_layers(header.song_layers, version),
+                    self.parse_instruments(version))
 
     def read_numeric(self, fmt):
-        return fmt.unpack(self.buffer.read(fmt.size))[0]
+        value = fmt.unpack_from(self.data, self.pos)[0]
+        self.pos += fmt.size
+        return value
+
+    def read_struct(self, fmt):
+        values = fmt.unpack_from(self.data, self.pos)
+        self.pos += fmt.size
+        return values
 
     def read_string(self):
         length = self.read_numeric(INT)
-        return self.buffer.read(length).decode()
-
-    def jump(self):
-        value = -1
-        while True:
-            jump = self.read_numeric(SHORT)
-            if not jump:
-                break
-            value += jump
-            yield value
+        if not length:
+            return ''
+        value = utf_8_decode(self.data[self.pos:self.pos + length],
+                             'strict', True)[0]
+        self.pos += length
+        return value
 
     def parse_header(self):
         song_length = self.read_numeric(SHORT)
@@ -149,131 +178,214 @@ class Parser(object):
         else:
             version = 0
 
+        if version >= 3:
+            default_instruments, song_length, song_layers = self.read_struct(HEADER_V3)
+        elif version > 0:
+            default_instruments, song_layers = self.read_struct(HEADER_V1)
+        else:
+            default_instruments, song_layers = 10, self.read_numeric(SHORT)
+
+        song_name       = self.read_string()
+        song_author     = self.read_string()
+        original_author = self.read_string()
+        description     = self.read_string()
+
+        tempo, auto_save, auto_save_duration, time_signature = \
+            self.read_struct(HEADER_SETTINGS)
+        minutes_spent, left_clicks, right_clicks, blocks_added, blocks_removed = \
+            self.read_struct(HEADER_STATS)
+        song_origin = self.read_string()
+
+        if version >= 4:
+            loop, max_loop_count, loop_start = self.read_struct(HEADER_LOOP)
+        else:
+            loop, max_loop_count, loop_start = 0, 0, 0
+
         return {
             'version':             version,
-            'default_instruments': self.read_numeric(BYTE)  if version > 0 else 10,
-            'song_length':         self.read_numeric(SHORT) if version >= 3 else song_length,
-            'song_layers':         self.read_numeric(SHORT),
-            'song_name':           self.read_string(),
-            'song_author':         self.read_string(),
-            'original_author':     self.read_string(),
-            'description':         self.read_string(),
-
-            'tempo':               self.read_numeric(SHORT) / 100.0,
-            'auto_save':           self.read_numeric(BYTE) == 1,
-            'auto_save_duration':  self.read_numeric(BYTE),
-            'time_signature':      self.read_numeric(BYTE),
-
-            'minutes_spent':       self.read_numeric(INT),
-            'left_clicks':         self.read_numeric(INT),
-            'right_clicks':        self.read_numeric(INT),
-            'blocks_added':        self.read_numeric(INT),
-            'blocks_removed':      self.read_numeric(INT),
-            'song_origin':         self.read_string(),
-            'loop':                self.read_numeric(BYTE) == 1 if version >= 4 else False,
-            'max_loop_count':      self.read_numeric(BYTE)      if version >= 4 else 0,
-            'loop_start':          self.read_numeric(SHORT)     if version >= 4 else 0
+            'default_instruments': default_instruments,
+            'song_length':         song_length,
+            'song_layers':         song_layers,
+            'song_name':           song_name,
+            'song_author':         song_author,
+            'original_author':     original_author,
+            'description':         description,
+
+            'tempo':               tempo / 100.0,
+            'auto_save':           auto_save == 1,
+            'auto_save_duration':  auto_save_duration,
+            'time_signature':      time_signature,
+
+            'minutes_spent':       minutes_spent,
+            'left_clicks':         left_clicks,
+            'right_clicks':        right_clicks,
+            'blocks_added':        blocks_added,
+            'blocks_removed':      blocks_removed,
+            'song_origin':         song_origin,
+            'loop':                loop == 1,
+            'max_loop_count':      max_loop_count,
+            'loop_start':          loop_start
         }
 
     def parse_notes(self, version):
-        for current_tick in self.jump():
-            for current_layer in self.jump():
-                instrument = self.read_numeric(BYTE)
-                key        = self.read_numeric(BYTE)
-                velocity   = self.read_numeric(BYTE)       if version >= 4 else 100
-                panning    = self.read_numeric(BYTE) - 100 if version >= 4 else 0
-                pitch      = self.read_numeric(SSHORT)     if version >= 4 else 0
-                yield Note(current_tick, current_layer, instrument,
-                           key, velocity, panning, pitch)
+        fmt = NOTE_V4 if version >= 4 else NOTE
+        data, pos = self.data, self.pos
+        unpack_short, short_size = SHORT.unpack_from, SHORT.size
+        unpack_note, note_size = fmt.unpack_from, fmt.size
+        notes = []
+        append, make = notes.append, Note._make
+        current_tick = -1
+
+        while True:
+            jump = unpack_short(data, pos)[0]
+            pos += short_size
+            if not jump:
+                break
+            current_tick += jump
+            current_layer = -1
+
+            while True:
+                jump = unpack_short(data, pos)[0]
+                pos += short_size
+                if not jump:
+                    break
+                current_layer += jump
+
+                fields = unpack_note(data, pos)
+                pos += note_size
+                if version >= 4:
+                    instrument, key, velocity, panning, pitch = fields
+                    append(make((current_tick, current_layer, instrument,
+                                 key, velocity, panning - 100, pitch)))
+                else:
+                    append(make((current_tick, current_layer) + fields
+                                + NOTE_DEFAULTS))
+
+        self.pos = pos
+        return notes
 
     def parse_layers(self, layers_count, version):
+        layers = [None] * layers_count
         for i in range(layers_count):
             name    = self.read_string()
             lock    = self.read_numeric(BYTE) == 1  if version >= 4 else False
             volume  = self.read_numeric(BYTE)
             panning = self.read_numeric(BYTE) - 100 if version >= 2 else 0
-            yield Layer(i, name, lock, volume, panning)
+            layers[i] = Layer(i, name, lock, volume, panning)
+        return layers
 
     def parse_instruments(self, version):
-        for i in range(self.read_numeric(BYTE)):
+        instruments_count = self.read_numeric(BYTE)
+        instruments = [None] * instruments_count
+        for i in range(instruments_count):
             name       = self.read_string()
             sound_file = self.read_string()
             pitch      = self.read_numeric(BYTE)
             press_key  = self.read_numeric(BYTE) == 1
-            yield Instrument(i, name, sound_file, pitch, press_key)
+            instruments[i] = Instrument(i, name, sound_file, pitch, press_key)
+        return instruments
 
 
 class Writer(object):
     def __init__(self, buff):
         self.buffer = buff
+        self.data = bytearray()
 
     def encode_file(self, nbs_file, version):
+        self.data = bytearray()
         self.write_header(nbs_file, version)
         self.write_notes(nbs_file, version)
         self.write_layers(nbs_file, version)
         self.write_instruments(nbs_file, version)
+        self.flush()
+
+    def flush(self):
+        # The write_* methods only fill self.data, nothing reaches the
+        # underlying buffer until it is flushed
+        self.buffer.write(self.data)
+        self.data = bytearray()
 
     def encode_numeric(self, fmt, value):
-        self.buffer.write(fmt.pack(value))
+        self.data += fmt.pack(value)
+
+    def encode_struct(self, fmt, *values):
+        self.data += fmt.pack(*values)
 
     def encode_string(self, value):
-        self.encode_numeric(INT, len(value))
-        self.buffer.write(value.encode())
+        if not value:
+            self.data += EMPTY_STRING
+            return
+        encoded = value.encode('utf-8')
+        self.encode_numeric(INT, len(encoded))
+        self.data += encoded
 
     def write_header(self, nbs_file, version):
         header = nbs_file.header
 
-        if version > 0:
+        if version >= 3:
             self.encode_numeric(SHORT, 0)
             self.encode_numeric(BYTE, version)
-            self.encode_numeric(BYTE, header.default_instruments)
+            self.encode_struct(HEADER_V3, header.default_instruments,
+                               header.song_length, header.song_layers)
+        elif version > 0:
+            self.encode_numeric(SHORT, 0)
+            self.encode_numeric(BYTE, version)
+            self.encode_struct(HEADER_V1, header.default_instruments,
+                               header.song_layers)
         else:
             self.encode_numeric(SHORT, header.song_length)
-        if version >= 3:
-            self.encode_numeric(SHORT, header.song_length)
-        self.encode_numeric(SHORT, header.song_layers)
+            self.encode_numeric(SHORT, header.song_layers)
         self.encode_string(header.song_name)
         self.encode_string(header.song_author)
         self.encode_string(header.original_author)
         self.encode_string(header.description)
 
-        self.encode_numeric(SHORT, int(header.tempo * 100))
-        self.encode_numeric(BYTE, int(header.auto_save))
-        self.encode_numeric(BYTE, header.auto_save_duration)
-        self.encode_numeric(BYTE, header.time_signature)
-
-        self.encode_numeric(INT, header.minutes_spent)
-        self.encode_numeric(INT, header.left_clicks)
-        self.encode_numeric(INT, header.right_clicks)
-        self.encode_numeric(INT, header.blocks_added)
-        self.encode_numeric(INT, header.blocks_removed)
+        self.encode_struct(HEADER_SETTINGS, int(header.tempo * 100),
+                           int(header.auto_save), header.auto_save_duration,
+                           header.time_signature)
+        self.encode_struct(HEADER_STATS, header.minutes_spent,
+                           header.left_clicks, header.right_clicks,
+                           header.blocks_added, header.blocks_removed)
         self.encode_string(header.song_origin)
 
         if version >= 4:
-            self.encode_numeric(BYTE, int(header.loop))
-            self.encode_numeric(BYTE, header.max_loop_count)
-            self.encode_numeric(SHORT, header.loop_start)
+            self.encode_struct(HEADER_LOOP, int(header.loop),
+                               header.max_loop_count, header.loop_start)
 
     def write_notes(self, nbs_file, version):
+        data = self.data
+        pack_short = SHORT.pack
+        terminator = pack_short(0)
         current_tick = -1
 
-        for tick, chord in nbs_file:
-            self.encode_numeric(SHORT, tick - current_tick)
-            current_tick = tick
-            current_layer = -1
-
-            for note in chord:
-                self.encode_numeric(SHORT, note.layer - current_layer)
-                current_layer = note.layer
-                self.encode_numeric(BYTE, note.instrument)
-                self.encode_numeric(BYTE, note.key)
-                if version >= 4:
-                    self.encode_numeric(BYTE, note.velocity)
-                    self.encode_numeric(BYTE, note.panning + 100)
-                    self.encode_numeric(SSHORT, note.pitch)
-
-            self.encode_numeric(SHORT, 0)
-        self.encode_numeric(SHORT, 0)
+        if version >= 4:
+            pack_note = LAYER_NOTE_V4.pack
+            for tick, chord in nbs_file:
+                data += pack_short(tick - current_tick)
+                current_tick = tick
+                current_layer = -1
+
+                for note in chord:
+                    data += pack_note(
+                        note.layer - current_layer, note.instrument, note.key,
+                        note.velocity, note.panning + 100, note.pitch)
+                    current_layer = note.layer
+
+                data += terminator
+        else:
+            pack_note = LAYER_NOTE.pack
+            for tick, chord in nbs_file:
+                data += pack_short(tick - current_tick)
+                current_tick = tick
+                current_layer = -1
+
+                for note in chord:
+                    data += pack_note(
+                        note.layer - current_layer, note.instrument, note.key)
+                    current_layer = note.layer
+
+                data += terminator
+        data += terminator
 
     def write_layers(self, nbs_file, version):
         for layer in nbs_file.layers: